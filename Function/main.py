@@ -1,17 +1,29 @@
+"""
+FootyIQ Cloud Functions: Telegram auth bridge, quiz upload/listing, score submission and leaderboard.
+
+Performance notes: the hot path is IO-bound on Firestore round-trips and Firebase ID token
+verification, not on computation. Optimize by caching, batching writes and cutting Firestore
+reads. Native or SIMD hashing is not worth it: the Telegram check is a single-block HMAC-SHA256,
+and stdlib hmac/hashlib already run it through OpenSSL, which uses SHA extensions where available.
+"""
 import os
 import time
-import json
 import hashlib
 import hmac
 import urllib.parse
-from datetime import datetime, timedelta
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
 
 # Import Firebase Admin/Functions SDKs
 import firebase_admin
 from firebase_admin import firestore, auth
 from firebase_functions import https_fn, options
 from firebase_admin.exceptions import FirebaseError
+# firebase_admin.firestore does not re-export FieldPath
+from google.cloud.firestore_v1.field_path import FieldPath
 
 # --- Configuration and Initialization ---
 
@@ -30,6 +42,83 @@ APP_ID = os.environ.get('APP_ID', 'default-footy-iq-app-id')
 ADMIN_USER_ID = os.environ.get('ADMIN_USER_ID') # Your Telegram/Firebase UID
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 
+# Public quiz metadata fields returned by get_active_quizzes
+_ACTIVE_QUIZ_FIELDS = ['quizId', 'name', 'title', 'expiresAt', 'totalQuestions', 'totalPoints', 'timeLimitSeconds']
+_ACTIVE_QUIZZES_LIMIT = 100
+
+# Quiz fields kept only on the secure copy (answers and scoring data)
+_SECURE_ONLY_QUIZ_FIELDS = frozenset({'questions', 'answerMap', 'pointsPerQuestion'})
+
+# Secure quiz fields needed to score a submission
+_SECURE_QUIZ_SCORING_FIELDS = ['answerMap', 'pointsPerQuestion', 'totalPoints', 'totalQuestions', 'expiresAt']
+
+# Upper bound on answers accepted per submission, so the scoring loop stays bounded
+_MAX_ANSWERS = 200
+
+# Pre-encoded bodies for the common error responses
+_METHOD_NOT_ALLOWED = b"Method Not Allowed"
+_ERR_UNAUTHORIZED = orjson.dumps({'error': 'Unauthorized: Missing or invalid token.'})
+_ERR_FORBIDDEN = orjson.dumps({'error': 'Forbidden: User is not the designated admin.'})
+_ERR_INTERNAL = orjson.dumps({'error': 'Internal server error.'})
+
+# Firestore references under artifacts/{APP_ID}. APP_ID is fixed per instance,
+# so build these once instead of formatting paths on every request.
+_ARTIFACT_ROOT = db.collection('artifacts').document(APP_ID)
+_SECURE_QUIZZES = _ARTIFACT_ROOT.collection('admin').document('data').collection('quizzes')
+_PUBLIC_DATA = _ARTIFACT_ROOT.collection('public').document('data')
+_ACTIVE_QUIZZES = _PUBLIC_DATA.collection('activeQuizzes')
+_LEADERBOARD = _PUBLIC_DATA.collection('leaderboard')
+_USERS = _ARTIFACT_ROOT.collection('users')
+
+# Telegram WebApp secret key: HMAC-SHA256 of the bot token keyed with "WebAppData".
+# It only depends on the bot token, so derive it once per instance.
+_TG_SECRET_KEY = hmac.digest(b"WebAppData", TELEGRAM_BOT_TOKEN.encode(), 'sha256') if TELEGRAM_BOT_TOKEN else None
+
+# initData older than this (seconds since its auth_date) is rejected
+_TG_AUTH_MAX_AGE = 86400
+
+# Process-local cache of verified Telegram initData: sha256(init_data) -> (cache_expiry, user_data).
+# Keyed on the whole payload so a cached hash can never vouch for different fields.
+_TG_INIT_DATA_CACHE: dict[bytes, tuple[float, dict]] = {}
+_TG_INIT_DATA_CACHE_MAX = 10000
+_TG_INIT_DATA_CACHE_TTL = 3600
+
+# Process-local cache of verified ID tokens: sha256(token) -> (uid, cache_expiry).
+# Warm instances skip auth.verify_id_token for tokens they have already seen.
+_TOKEN_CACHE: dict[bytes, tuple[str, float]] = {}
+_TOKEN_CACHE_MAX = 10000
+# Re-verify cached tokens at least this often, even if they are still valid
+_TOKEN_CACHE_TTL = 60
+# Treat cached tokens as expired slightly early to absorb clock skew.
+_TOKEN_EXP_LEEWAY = 30
+
+# Process-local cache of scoring data derived from secure quiz documents:
+# quiz_id -> (cache_expiry, correct_map, points_per_question).
+# Repeat submissions skip the Firestore read. A re-upload of the same quizId only
+# clears the uploading instance's entry, so keep the TTL short: other warm instances
+# may score against the previous answer key for up to _QUIZ_CACHE_TTL seconds.
+_QUIZ_CACHE: dict[str, tuple[float, dict, float]] = {}
+_QUIZ_CACHE_MAX = 256
+_QUIZ_CACHE_TTL = 30
+
+# Shared pool for overlapping independent network calls within a request
+_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Telegram UIDs whose profile document is known to exist, so repeat launches
+# on a warm instance skip the existence read.
+_KNOWN_PROFILES: set[str] = set()
+_KNOWN_PROFILES_MAX = 10000
+
+# Serialized leaderboard response: (cache_expiry, payload). Leaderboards are
+# inherently a little stale, so warm instances serve the same bytes briefly.
+_LB_CACHE: tuple[float, bytes] | None = None
+_LB_CACHE_TTL = 15
+
+# Serialized active quizzes response: (cache_expiry, payload). The list only
+# changes when an admin uploads, but every client open polls it.
+_ACTIVE_QUIZZES_CACHE: tuple[float, bytes] | None = None
+_ACTIVE_QUIZZES_CACHE_TTL = 30
+
 
 # --- Utility Functions ---
 
@@ -40,67 +129,157 @@ def get_user_id_from_token(req: https_fn.Request) -> str | None:
         return None
     
     id_token = auth_header.split('Bearer ')[1]
+    token_key = hashlib.sha256(id_token.encode()).digest()
+
+    now = time.time()
+    cached = _TOKEN_CACHE.get(token_key)
+    if cached:
+        uid, cache_expiry = cached
+        if cache_expiry > now:
+            return uid
+        _TOKEN_CACHE.pop(token_key, None)
     
     try:
         # Verify the ID token using the Firebase Admin SDK
         decoded_token = auth.verify_id_token(id_token)
-        return decoded_token['uid']
     except Exception as e:
         print(f"Token verification failed: {e}")
         return None
 
+    uid = decoded_token['uid']
+    if len(_TOKEN_CACHE) >= _TOKEN_CACHE_MAX:
+        # Evict the oldest entry (dicts preserve insertion order)
+        _TOKEN_CACHE.pop(next(iter(_TOKEN_CACHE)), None)
+    _TOKEN_CACHE[token_key] = (uid, min(decoded_token['exp'] - _TOKEN_EXP_LEEWAY, now + _TOKEN_CACHE_TTL))
+    return uid
+
+def get_json_body(req: https_fn.Request) -> dict | None:
+    """Parses the request body as a JSON object with orjson. Returns None if it is not one."""
+    try:
+        data = orjson.loads(req.get_data())
+    except orjson.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def ensure_user_profile(telegram_uid: str, telegram_user: dict) -> None:
+    """Creates the user's game profile on first sign-in, otherwise refreshes name and login time."""
+    user_profile_ref = get_user_profile_ref(telegram_uid)
+    name = telegram_user.get('first_name', 'Player') + (f" ({telegram_user.get('username')})" if telegram_user.get('username') else "")
+    if telegram_uid in _KNOWN_PROFILES or user_profile_ref.get(field_paths=['telegram_id']).exists:
+        user_profile_ref.update({
+            'name': name,
+            'last_login': firestore.SERVER_TIMESTAMP
+        })
+    else:
+        user_profile_ref.set({
+            'telegram_id': telegram_uid,
+            'name': name,
+            'score': 0,
+            'last_login': firestore.SERVER_TIMESTAMP
+        }, merge=True)
+
+    if len(_KNOWN_PROFILES) >= _KNOWN_PROFILES_MAX:
+        _KNOWN_PROFILES.clear()
+    _KNOWN_PROFILES.add(telegram_uid)
+
+def _prewarm_id_token_certs() -> None:
+    """
+    Fetches Google's ID token signing certificates through firebase-admin's own
+    cache-control session, so the first verify_id_token call on a fresh instance
+    does not pay for the certificate download.
+    """
+    try:
+        verifier = auth._get_client(None)._token_verifier
+        verifier.request(url=verifier.id_token_verifier.cert_url, method='GET')
+    except Exception as e:
+        print(f"ID token certificate prewarm failed (will fetch on first use): {e}")
+
+def get_user_profile_ref(user_id: str) -> firestore.DocumentReference:
+    """Returns the reference to a user's game profile document."""
+    return _USERS.document(user_id).collection('gameData').document('profile')
+
 def verify_telegram_data(init_data: str) -> dict | None:
     """
     Cryptographically verifies the Telegram WebApp initData hash using the Bot Token.
     Returns the verified data dictionary if successful, or None if validation fails.
     (Adopted official Telegram verification method from your provided code.)
     """
-    if not TELEGRAM_BOT_TOKEN:
+    if not _TG_SECRET_KEY:
         print("TELEGRAM_BOT_TOKEN not set in environment variables.")
         return None
+
+    # Repeat launches with the same initData skip parsing and HMAC entirely
+    now = time.time()
+    cache_key = hashlib.sha256(init_data.encode()).digest()
+    cached = _TG_INIT_DATA_CACHE.get(cache_key)
+    if cached:
+        if cached[0] > now:
+            return cached[1]
+        _TG_INIT_DATA_CACHE.pop(cache_key, None)
     
-    # 1. Separate hash from other parameters
-    parsed_data = urllib.parse.parse_qs(init_data)
-    
-    if 'hash' not in parsed_data:
+    # 1. Separate hash from other parameters in a single pass
+    hash_value = None
+    user_raw = None
+    auth_date = None
+    pairs = []
+    unquote = urllib.parse.unquote_plus
+    for field in init_data.split('&'):
+        key, _, value = field.partition('=')
+        if not key:
+            continue
+        # Telegram signs the URL-decoded values, so they must still be unquoted
+        value = unquote(value)
+        if key == 'hash':
+            hash_value = value
+            continue
+        if key == 'user':
+            user_raw = value
+        elif key == 'auth_date':
+            auth_date = value
+        pairs.append((key, value))
+
+    if hash_value is None:
+        return None
+
+    # Reject stale initData so captured payloads cannot be replayed indefinitely
+    try:
+        auth_date = int(auth_date)
+    except (TypeError, ValueError):
+        return None
+    if now - auth_date > _TG_AUTH_MAX_AGE:
+        print(f"Telegram initData expired (auth_date={auth_date}).")
         return None
-        
-    hash_value = parsed_data.pop('hash')[0]
 
     # 2. Sort and concatenate parameters (excluding hash)
-    # The sort order is crucial for verification
-    check_string = '&'.join([
-        f'{key}={value[0]}' 
-        for key, value in sorted(parsed_data.items())
-    ])
-
-    # 3. Calculate Secret Key
-    secret_key = hmac.new(
-        key=b"WebAppData",
-        # Use the Telegram Bot Token for HMAC key creation
-        msg=TELEGRAM_BOT_TOKEN.encode(),
-        digestmod=hashlib.sha256
-    ).digest()
-
-    # 4. Calculate HMAC against the check string
-    calculated_hash = hmac.new(
-        key=secret_key,
-        msg=check_string.encode(),
-        digestmod=hashlib.sha256
-    ).hexdigest()
-
-    # 5. Compare and Validate
-    if calculated_hash != hash_value:
+    # The sort order is crucial for verification; Telegram joins fields with '\n'
+    pairs.sort()
+    check_string = '\n'.join(f'{key}={value}' for key, value in pairs)
+
+    # 3. Calculate HMAC against the check string (secret key is precomputed at import)
+    calculated_hash = hmac.digest(_TG_SECRET_KEY, check_string.encode(), 'sha256').hex()
+
+    # 4. Compare and Validate
+    # Compare as bytes: compare_digest rejects str operands with non-ASCII characters,
+    # and the received hash is client-controlled
+    if not hmac.compare_digest(calculated_hash.encode(), hash_value.encode()):
         print(f"Telegram hash validation failed. Calculated: {calculated_hash}, Received: {hash_value}")
         return None
         
     # Validation successful. Extract user data.
-    if 'user' in parsed_data:
-        user_data = json.loads(parsed_data['user'][0])
+    if user_raw is not None:
+        user_data = orjson.loads(user_raw)
+
+        # Cache the verified user until the TTL elapses or the initData goes stale
+        if len(_TG_INIT_DATA_CACHE) >= _TG_INIT_DATA_CACHE_MAX:
+            _TG_INIT_DATA_CACHE.pop(next(iter(_TG_INIT_DATA_CACHE)), None)
+        _TG_INIT_DATA_CACHE[cache_key] = (min(now + _TG_INIT_DATA_CACHE_TTL, auth_date + _TG_AUTH_MAX_AGE), user_data)
         return user_data
         
     return None
 
+# Warm the certificate cache off the request path during cold start
+threading.Thread(target=_prewarm_id_token_certs, daemon=True).start()
+
 # --- 0. TELEGRAM AUTH BRIDGE FUNCTION ---
 # Endpoint: POST /auth/telegram
 @https_fn.on_request(
@@ -111,44 +290,44 @@ def telegram_auth_bridge(req: https_fn.Request) -> https_fn.Response:
     Secures the Telegram Mini App by verifying initData and minting a Firebase Custom Token.
     """
     if req.method != 'POST':
-        return https_fn.Response("Method Not Allowed", status=405)
+        return https_fn.Response(_METHOD_NOT_ALLOWED, status=405)
 
     try:
-        data = req.get_json(silent=True)
-        init_data = data.get('initData')
+        data = get_json_body(req)
+        init_data = data.get('initData') if data else None
         
         if not init_data:
-            return https_fn.Response(json.dumps({'error': 'Missing initData in payload.'}), status=400, content_type="application/json")
+            return https_fn.Response(orjson.dumps({'error': 'Missing initData in payload.'}), status=400, content_type="application/json")
 
         telegram_user = verify_telegram_data(init_data)
 
         if not telegram_user:
-            return https_fn.Response(json.dumps({'error': 'Invalid or expired Telegram initiation data.'}), status=401, content_type="application/json")
+            return https_fn.Response(orjson.dumps({'error': 'Invalid or expired Telegram initiation data.'}), status=401, content_type="application/json")
 
         # Extract Telegram User ID (UID for Firebase)
         telegram_uid = str(telegram_user['id'])
         
-        # Mint the Firebase Custom Token
-        custom_token = auth.create_custom_token(telegram_uid, {
+        # Mint the Firebase Custom Token in the background while the profile is
+        # written; both are independent network round-trips
+        token_future = _EXECUTOR.submit(auth.create_custom_token, telegram_uid, {
             'telegram_id': telegram_uid,
             'username': telegram_user.get('username'),
             'first_name': telegram_user.get('first_name')
         })
 
-        # Ensure User Profile Exists (Initialize profile data if first login)
-        user_profile_ref = db.document(f'artifacts/{APP_ID}/users/{telegram_uid}/gameData/profile')
-        user_profile_ref.set({
-            'telegram_id': telegram_uid,
-            'name': telegram_user.get('first_name', 'Player') + (f" ({telegram_user.get('username')})" if telegram_user.get('username') else ""),
-            'score': 0,
-            'last_login': firestore.SERVER_TIMESTAMP
-        }, merge=True)
+        # Ensure User Profile Exists
+        ensure_user_profile(telegram_uid, telegram_user)
+        custom_token = token_future.result()
 
-        return https_fn.Response(json.dumps({'customToken': custom_token.decode('utf-8')}), status=200, content_type="application/json")
+        # create_custom_token returns a signed JWT as bytes. JWTs are base64url segments
+        # joined by '.', and the Telegram UID is numeric, so neither needs JSON escaping
+        # and the body can be assembled without decoding and re-encoding the token.
+        body = b'{"customToken":"' + custom_token + b'","telegramId":"' + telegram_uid.encode() + b'"}'
+        return https_fn.Response(body, status=200, content_type="application/json")
 
     except Exception as e:
         print(f"Error in Telegram Auth Bridge: {e}")
-        return https_fn.Response(json.dumps({'error': 'Internal authentication error.'}), status=500, content_type="application/json")
+        return https_fn.Response(orjson.dumps({'error': 'Internal authentication error.'}), status=500, content_type="application/json")
 
 # --- 1. ADMIN QUIZ UPLOAD FUNCTION ---
 # Endpoint: POST /admin/upload_quiz
@@ -160,55 +339,70 @@ def admin_upload_quiz(req: https_fn.Request) -> https_fn.Response:
     Secured function to upload a new quiz to Firestore. 
     Requires valid Firebase ID Token and matching ADMIN_USER_ID.
     """
+    global _ACTIVE_QUIZZES_CACHE
     if req.method != 'POST':
-        return https_fn.Response("Method Not Allowed", status=405)
+        return https_fn.Response(_METHOD_NOT_ALLOWED, status=405)
 
     try:
         # Step 1: Authentication and Authorization Check
         user_id = get_user_id_from_token(req)
         if not user_id:
-            return https_fn.Response(json.dumps({'error': 'Unauthorized: Missing or invalid token.'}), status=401, content_type="application/json")
+            return https_fn.Response(_ERR_UNAUTHORIZED, status=401, content_type="application/json")
             
         if user_id != ADMIN_USER_ID:
             print(f"Unauthorized admin attempt by user: {user_id}")
-            return https_fn.Response(json.dumps({'error': 'Forbidden: User is not the designated admin.'}), status=403, content_type="application/json")
+            return https_fn.Response(_ERR_FORBIDDEN, status=403, content_type="application/json")
 
         # Step 2: Parse and Validate Data
-        data = req.get_json(silent=True)
+        data = get_json_body(req)
         if not data or 'quizId' not in data or 'questions' not in data:
-            return https_fn.Response(json.dumps({'error': 'Invalid request body or missing quizId/questions.'}), status=400, content_type="application/json")
+            return https_fn.Response(orjson.dumps({'error': 'Invalid request body or missing quizId/questions.'}), status=400, content_type="application/json")
 
         quiz_id = data['quizId']
         # Ensure 'expiresAt' is set, otherwise set it for 24 hours from now
-        expires_at = data.get('expiresAt', int((datetime.now() + timedelta(days=1)).timestamp() * 1000))
+        expires_at = data.get('expiresAt', int(time.time() * 1000) + 86_400_000)
 
         # Separate data into secure (with answers) and public (without answers)
         secure_quiz_data = data
+        secure_quiz_data['expiresAt'] = expires_at
+        # Precomputed answer lookup so submissions can fetch just this map
+        # (Firestore map keys must be strings)
+        secure_quiz_data['answerMap'] = {str(q['questionId']): q['correctAnswer'] for q in data['questions']}
+        total_questions = len(data['questions'])
+        if total_questions:
+            # Same scoring defaults as submit_quiz_score: 10 points per question
+            total_points = data.get('totalPoints') or (total_questions * 10)
+            secure_quiz_data['pointsPerQuestion'] = total_points / total_questions
         
-        public_quiz_data = {
-            k: v for k, v in data.items() if k not in ['questions']
-        }
+        public_quiz_data = dict(data)
+        for field in _SECURE_ONLY_QUIZ_FIELDS:
+            public_quiz_data.pop(field, None)
         
         public_quiz_data['quizId'] = quiz_id
         public_quiz_data['expiresAt'] = expires_at
-        public_quiz_data['totalQuestions'] = len(data['questions'])
+        public_quiz_data['totalQuestions'] = total_questions
 
 
         # Step 3: Write to Firestore 
-        secure_ref = db.collection(f'artifacts/{APP_ID}/admin/quizzes').document(quiz_id)
-        public_ref = db.collection(f'artifacts/{APP_ID}/public/data/activeQuizzes').document(quiz_id)
+        secure_ref = _SECURE_QUIZZES.document(quiz_id)
+        public_ref = _ACTIVE_QUIZZES.document(quiz_id)
         
+        # Commit both writes in a single round-trip
+        batch = db.batch()
         # Secure Write (Full quiz data including answers)
-        secure_ref.set(secure_quiz_data)
-        
+        batch.set(secure_ref, secure_quiz_data)
         # Public Write (Quiz metadata)
-        public_ref.set(public_quiz_data)
+        batch.set(public_ref, public_quiz_data)
+        batch.commit()
+        # Drop this instance's cached copies so the new quiz is served immediately
+        _QUIZ_CACHE.pop(quiz_id, None)
+        _ACTIVE_QUIZZES_CACHE = None
 
-        return https_fn.Response(json.dumps({'message': f'Quiz {quiz_id} uploaded successfully.', 'quizId': quiz_id}), status=200, content_type="application/json")
+        return https_fn.Response(orjson.dumps({'message': f'Quiz {quiz_id} uploaded successfully.', 'quizId': quiz_id}), status=200, content_type="application/json")
 
     except Exception as e:
         print(f"Error during admin quiz upload: {e}")
-        return https_fn.Response(json.dumps({'error': 'Internal server error.'}), status=500, content_type="application/json")
+        return https_fn.Response(_ERR_INTERNAL, status=500, content_type="application/json")
 
 # --- 2. GET ACTIVE QUIZZES FUNCTION ---
 # Endpoint: GET /quiz/active
@@ -220,26 +414,36 @@ def get_active_quizzes(req: https_fn.Request) -> https_fn.Response:
     Public function to fetch all currently active quiz IDs and metadata.
     """
     if req.method != 'GET':
-        return https_fn.Response("Method Not Allowed", status=405)
+        return https_fn.Response(_METHOD_NOT_ALLOWED, status=405)
+
+    global _ACTIVE_QUIZZES_CACHE
+    now = time.time()
+    if _ACTIVE_QUIZZES_CACHE and _ACTIVE_QUIZZES_CACHE[0] > now:
+        return https_fn.Response(_ACTIVE_QUIZZES_CACHE[1], status=200, content_type="application/json")
         
     try:
-        active_quizzes_ref = db.collection(f'artifacts/{APP_ID}/public/data/activeQuizzes')
-        now = int(time.time() * 1000)
         
-        # Filter for quizzes that have not yet expired
-        q = active_quizzes_ref.where('expiresAt', '>', now)
+        # Filter for quizzes that have not yet expired, returning only the metadata the client uses
+        q = (_ACTIVE_QUIZZES
+             .where('expiresAt', '>', int(now * 1000))
+             .select(_ACTIVE_QUIZ_FIELDS)
+             .order_by('expiresAt')
+             .limit(_ACTIVE_QUIZZES_LIMIT))
         
         # Fetch data
         docs = q.stream()
         quizzes = []
         for doc in docs:
             quizzes.append(doc.to_dict())
+
+        payload = orjson.dumps({'quizzes': quizzes})
+        _ACTIVE_QUIZZES_CACHE = (now + _ACTIVE_QUIZZES_CACHE_TTL, payload)
         
-        return https_fn.Response(json.dumps({'quizzes': quizzes}), status=200, content_type="application/json")
+        return https_fn.Response(payload, status=200, content_type="application/json")
 
     except Exception as e:
         print(f"Error fetching active quizzes: {e}")
-        return https_fn.Response(json.dumps({'error': 'Internal server error.'}), status=500, content_type="application/json")
+        return https_fn.Response(_ERR_INTERNAL, status=500, content_type="application/json")
 
 # --- 3. SCORE SUBMISSION AND VALIDATION FUNCTION (CRITICAL) ---
 # Endpoint: POST /quiz/submit
@@ -251,80 +455,114 @@ def submit_quiz_score(req: https_fn.Request) -> https_fn.Response:
     Secured function to validate user answers, calculate score, and update user profile using a transaction.
     """
     if req.method != 'POST':
-        return https_fn.Response("Method Not Allowed", status=405)
+        return https_fn.Response(_METHOD_NOT_ALLOWED, status=405)
 
     try:
         # Step 1: Authentication
         user_id = get_user_id_from_token(req)
         if not user_id:
-            return https_fn.Response(json.dumps({'error': 'Unauthorized: Missing or invalid token.'}), status=401, content_type="application/json")
+            return https_fn.Response(_ERR_UNAUTHORIZED, status=401, content_type="application/json")
         
         # Step 2: Data Validation
-        data = req.get_json(silent=True)
+        data = get_json_body(req)
         if not data or 'quizId' not in data or 'answers' not in data:
-            return https_fn.Response(json.dumps({'error': 'Invalid payload.'}), status=400, content_type="application/json")
+            return https_fn.Response(orjson.dumps({'error': 'Invalid payload.'}), status=400, content_type="application/json")
 
         quiz_id = data['quizId']
         answers = data['answers'] 
+        if not isinstance(answers, list) or len(answers) > _MAX_ANSWERS:
+            return https_fn.Response(orjson.dumps({'error': 'Invalid payload.'}), status=400, content_type="application/json")
+
+        # Cheap projected read to reject duplicate submissions before doing any
+        # scoring or opening a transaction (the transaction re-checks for races)
+        user_profile_ref = get_user_profile_ref(user_id)
+        # Quote the quiz ID so IDs with dashes, dots or leading digits form a valid field path
+        completed_field = FieldPath('quizzes_completed', quiz_id).to_api_repr()
+        completed_snap = user_profile_ref.get(field_paths=[completed_field])
+        if completed_snap.exists and (completed_snap.to_dict() or {}).get('quizzes_completed', {}).get(quiz_id):
+            return https_fn.Response(orjson.dumps({'error': 'Quiz already completed by this user.'}), status=409, content_type="application/json")
 
         # Step 3: Fetch Secure Quiz Data (Answers)
-        secure_quiz_ref = db.collection(f'artifacts/{APP_ID}/admin/quizzes').document(quiz_id)
-        secure_quiz_snap = secure_quiz_ref.get()
-
-        if not secure_quiz_snap.exists:
-            return https_fn.Response(json.dumps({'error': 'Quiz not found or expired.'}), status=404, content_type="application/json")
-        
-        secure_quiz = secure_quiz_snap.to_dict()
-        
-        # Handle case where quiz data is missing score info (prevent division by zero)
-        total_questions = secure_quiz.get('totalQuestions') or len(secure_quiz.get('questions', []))
-        total_points = secure_quiz.get('totalPoints') or (total_questions * 10) # Default to 10 points per question
-        
-        if total_questions == 0:
-             return https_fn.Response(json.dumps({'error': 'Quiz structure is invalid (0 questions).'}), status=400, content_type="application/json")
-             
-        points_per_question = total_points / total_questions
+        now = time.time()
+        cached = _QUIZ_CACHE.get(quiz_id)
+        if cached and cached[0] > now:
+            _, correct_map, points_per_question = cached
+        else:
+            secure_quiz_ref = _SECURE_QUIZZES.document(quiz_id)
+            secure_quiz_snap = secure_quiz_ref.get(field_paths=_SECURE_QUIZ_SCORING_FIELDS)
+
+            if not secure_quiz_snap.exists:
+                return https_fn.Response(orjson.dumps({'error': 'Quiz not found or expired.'}), status=404, content_type="application/json")
+            
+            secure_quiz = secure_quiz_snap.to_dict()
+
+            # Map of questionId (as a string) -> correct answer. Quizzes uploaded before
+            # answerMap was stored need the full document to rebuild it.
+            correct_map = secure_quiz.get('answerMap')
+            if correct_map is None:
+                secure_quiz = secure_quiz_ref.get().to_dict()
+                correct_map = {str(q['questionId']): q['correctAnswer'] for q in secure_quiz.get('questions', [])}
         
-        # Create a map for quick lookup of correct answers
-        correct_map = {q['questionId']: q['correctAnswer'] for q in secure_quiz.get('questions', [])}
+            # Quizzes uploaded before pointsPerQuestion was stored derive it here
+            points_per_question = secure_quiz.get('pointsPerQuestion')
+            if points_per_question is None:
+                # Handle case where quiz data is missing score info (prevent division by zero)
+                total_questions = secure_quiz.get('totalQuestions') or len(correct_map)
+                total_points = secure_quiz.get('totalPoints') or (total_questions * 10) # Default to 10 points per question
+                
+                if total_questions == 0:
+                     return https_fn.Response(orjson.dumps({'error': 'Quiz structure is invalid (0 questions).'}), status=400, content_type="application/json")
+                     
+                points_per_question = total_points / total_questions
+
+            # Cache until the quiz expires, but never longer than the TTL
+            expires_at = secure_quiz.get('expiresAt')
+            cache_expiry = now + _QUIZ_CACHE_TTL
+            if expires_at:
+                cache_expiry = min(cache_expiry, expires_at / 1000)
+            if len(_QUIZ_CACHE) >= _QUIZ_CACHE_MAX:
+                _QUIZ_CACHE.pop(next(iter(_QUIZ_CACHE)), None)
+            _QUIZ_CACHE[quiz_id] = (cache_expiry, correct_map, points_per_question)
 
         # Step 4: Server-Side Score Calculation
-        correct_count = 0
-        total_answered = 0
-        
-        for answer in answers:
-            q_id = answer.get('questionId')
-            selected = answer.get('selectedOption')
-            
-            if q_id in correct_map and selected is not None:
-                total_answered += 1
-                if selected == correct_map[q_id]:
-                    correct_count += 1
+        # One pass: a bool per answered question that exists in the quiz (True if correct)
+        get_correct = correct_map.get
+        results = [
+            selected == correct
+            for answer in answers
+            if (selected := answer.get('selectedOption')) is not None
+            and (correct := get_correct(str(answer.get('questionId')))) is not None
+        ]
+        total_answered = len(results)
+        correct_count = sum(results)
 
         points_earned = int(correct_count * points_per_question)
 
         # Step 5: Update User Profile (Firestore Transaction)
-        user_profile_ref = db.document(f'artifacts/{APP_ID}/users/{user_id}/gameData/profile')
-        
         try:
             @firestore.transactional
-            def update_user_score_transaction(transaction, profile_ref, points, quiz_id, score_details):
-                snapshot = profile_ref.get(transaction=transaction)
+            def update_user_score_transaction(transaction, profile_ref, points, quiz_id, completed_field, score_details):
+                # Only fetch the fields the transaction needs, not the whole profile
+                snapshot = profile_ref.get(
+                    field_paths=['score', completed_field],
+                    transaction=transaction
+                )
+                profile = (snapshot.to_dict() if snapshot.exists else None) or {}
                 
                 # Check if user has already submitted this quiz
-                if snapshot.exists and snapshot.get(f'quizzes_completed.{quiz_id}'):
+                if profile.get('quizzes_completed', {}).get(quiz_id):
                     raise ValueError("Quiz already completed by this user.")
 
-                current_score = snapshot.get('score') or 0
+                current_score = profile.get('score') or 0
                 new_score = current_score + points
                 
-                # Update user data
+                # Update user data (set() treats dotted keys literally, so nest the maps)
                 transaction.set(profile_ref, {
                     'score': new_score,
                     'leagueScore': new_score, 
                     'globalRank': '#calculating', 
-                    f'quizzes_completed.{quiz_id}': firestore.SERVER_TIMESTAMP, 
-                    f'latest_submission.{quiz_id}': score_details 
+                    'quizzes_completed': {quiz_id: firestore.SERVER_TIMESTAMP}, 
+                    'latest_submission': {quiz_id: score_details} 
                 }, merge=True)
                 
                 return new_score
@@ -334,12 +572,13 @@ def submit_quiz_score(req: https_fn.Request) -> https_fn.Response:
                 user_profile_ref, 
                 points_earned, 
                 quiz_id,
+                completed_field,
                 {'points': points_earned, 'correct': correct_count, 'total': total_answered}
             )
 
             # Step 6: Success Response
             return https_fn.Response(
-                json.dumps({
+                orjson.dumps({
                     'message': 'Score submitted and validated successfully.',
                     'pointsEarned': points_earned,
                     'correctCount': correct_count,
@@ -350,16 +589,16 @@ def submit_quiz_score(req: https_fn.Request) -> https_fn.Response:
             )
 
         except TimeoutError:
-            return https_fn.Response(json.dumps({'error': 'Transaction timed out. Try again.'}), status=503, content_type="application/json")
+            return https_fn.Response(orjson.dumps({'error': 'Transaction timed out. Try again.'}), status=503, content_type="application/json")
         except ValueError as ve:
-            return https_fn.Response(json.dumps({'error': str(ve)}), status=409, content_type="application/json") # 409 Conflict for duplicate submission
+            return https_fn.Response(orjson.dumps({'error': str(ve)}), status=409, content_type="application/json") # 409 Conflict for duplicate submission
         except Exception as te:
             print(f"Firestore Transaction Error: {te}")
-            return https_fn.Response(json.dumps({'error': 'Failed to update score due to transaction error.'}), status=500, content_type="application/json")
+            return https_fn.Response(orjson.dumps({'error': 'Failed to update score due to transaction error.'}), status=500, content_type="application/json")
 
     except Exception as e:
         print(f"Unhandled error in submit_quiz_score: {e}")
-        return https_fn.Response(json.dumps({'error': 'Internal server error.'}), status=500, content_type="application/json")
+        return https_fn.Response(_ERR_INTERNAL, status=500, content_type="application/json")
 
 # --- 4. LEADERBOARD RETRIEVAL FUNCTION ---
 # Endpoint: GET /leaderboard/global
@@ -371,29 +610,35 @@ def get_global_leaderboard(req: https_fn.Request) -> https_fn.Response:
     Public function to fetch a simple global leaderboard.
     """
     if req.method != 'GET':
-        return https_fn.Response("Method Not Allowed", status=405)
+        return https_fn.Response(_METHOD_NOT_ALLOWED, status=405)
+
+    global _LB_CACHE
+    now = time.time()
+    if _LB_CACHE and _LB_CACHE[0] > now:
+        return https_fn.Response(_LB_CACHE[1], status=200, content_type="application/json")
 
     try:
-        leaderboard_ref = db.collection(f'artifacts/{APP_ID}/public/data/leaderboard')
-        
-        # Fetch top 50 entries
-        q = leaderboard_ref.order_by('score', direction=firestore.Query.DESCENDING).limit(50)
+        # Fetch top 50 entries, projecting only the fields the leaderboard returns
+        q = (_LEADERBOARD
+             .order_by('score', direction=firestore.Query.DESCENDING)
+             .limit(50)
+             .select(['name', 'score']))
         
-        docs = q.stream()
-        leaderboard = []
-        rank = 1
-        for doc in docs:
-            data = doc.to_dict()
-            leaderboard.append({
+        leaderboard = [
+            {
                 'rank': rank,
                 'userId': doc.id,
-                'name': data.get('name', 'Player'),
+                'name': (data := doc.to_dict()).get('name', 'Player'),
                 'score': data.get('score', 0)
-            })
-            rank += 1
+            }
+            for rank, doc in enumerate(q.stream(), start=1)
+        ]
+
+        payload = orjson.dumps({'leaderboard': leaderboard})
+        _LB_CACHE = (now + _LB_CACHE_TTL, payload)
             
-        return https_fn.Response(json.dumps({'leaderboard': leaderboard}), status=200, content_type="application/json")
+        return https_fn.Response(payload, status=200, content_type="application/json")
 
     except Exception as e:
         print(f"Error fetching leaderboard: {e}")
-        return https_fn.Response(json.dumps({'error': 'Internal server error.'}), status=500, content_type="application/json")
+        return https_fn.Response(_ERR_INTERNAL, status=500, content_type="application/json")